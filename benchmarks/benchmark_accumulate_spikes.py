@@ -0,0 +1,112 @@
+# Equivalence check and timing of the coincidental spikes filtering of test_process_spikes.py against the original
+# algorithm (8-connectivity lookup table + np.unique + np.intersect1d), on synthetic groups of 7 spikes files.
+# test_process_spikes.py loads the spikes database at import, so SPIKESDATA must be set as for the processing itself.
+#
+# Usage: python benchmark_accumulate_spikes.py [--size 4096] [--groups 20]
+# The lookup table of the original algorithm takes ~4 GB to build at full detector size. Use a smaller --size
+# on machines with less memory.
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import test_process_spikes as tps
+
+
+def build_lut_baseline(ny, nx):
+    # 8-connectivity lookup table as originally built in test_process_spikes.py, off-edge neighbours clipped.
+    coords_1d = np.arange(nx * ny)
+    coordy, coordx = np.unravel_index(coords_1d, [ny, nx])
+    coords2d = np.array([coordy, coordx])
+    coords2d_8nb = coords2d[np.newaxis, ...] + tps.coords_8nb[..., np.newaxis]
+    np.clip(coords2d_8nb, 0, nx - 1, out=coords2d_8nb)
+    return np.array([coords2d_8nb[i, 0, :] * nx + coords2d_8nb[i, 1, :] for i in range(len(tps.coords_8nb))],
+                    dtype='int32', order='C')
+
+
+def count_intersect_baseline(raw_spikes, coincidental_1d_coords, count_filter_idx, counts):
+    file_coords, idx1, idx2 = np.intersect1d(raw_spikes[0, :], coincidental_1d_coords, return_indices=True)
+    group_counts = counts[count_filter_idx[idx2]]
+    return file_coords, idx1, group_counts
+
+
+def accumulate_spikes_baseline(spikes_list, index_8nb, n_co_spikes=2):
+    cumulated_spikes_coords = np.unique(index_8nb[:, spikes_list[0][0, :]].ravel())
+    for raw_spikes in spikes_list[1:]:
+        cumulated_spikes_coords = np.concatenate([cumulated_spikes_coords,
+                                                  np.unique(index_8nb[:, raw_spikes[0, :]].ravel())])
+    (distrib_values, counts) = np.unique(cumulated_spikes_coords, return_counts=True)
+    count_filter_idx = np.where(counts >= n_co_spikes)[0]
+    coincidental_1d_coords = distrib_values[count_filter_idx]
+    return zip(*[count_intersect_baseline(raw_spikes, coincidental_1d_coords, count_filter_idx, counts)
+                 for raw_spikes in spikes_list])
+
+
+def generate_group(rng, ny, nx, n_wavelengths=7):
+    # Spikes files of one group: random spikes, plus a set of pixels shared by the wavelengths, each shifted by at
+    # most one pixel so that they fall within the 8 neighbours of each other. The detector edges and corners are
+    # always among them to exercise the off-edge neighbours. Coordinates are unique within a file, as in the real
+    # spikes files.
+    edges = np.array([[0, 0], [0, nx - 1], [ny - 1, 0], [ny - 1, nx - 1], [0, nx // 2], [ny // 2, 0]])
+    shared = np.concatenate([edges, np.column_stack([rng.integers(0, ny, 500), rng.integers(0, nx, 500)])])
+    spikes_list = []
+    for _ in range(n_wavelengths):
+        keep = shared[rng.random(len(shared)) < 0.5]
+        shifted = np.clip(keep + rng.integers(-1, 2, keep.shape), 0, [ny - 1, nx - 1])
+        coords = np.unique(np.concatenate([shifted[:, 0] * nx + shifted[:, 1],
+                                           rng.integers(0, ny * nx, rng.integers(1000, 20000))]))
+        rng.shuffle(coords)
+        n = coords.size
+        spikes_list.append(np.stack([coords, rng.integers(0, 16000, n), rng.integers(0, 16000, n)]).astype(np.int32))
+    return spikes_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4096, help='number of rows and columns of the detector')
+    parser.add_argument('--groups', type=int, default=20, help='number of synthetic groups')
+    args = parser.parse_args()
+
+    # accumulate_spikes() reads the detector size from the module.
+    tps.ny, tps.nx = args.size, args.size
+    rng = np.random.default_rng(0)
+    groups = [generate_group(rng, tps.ny, tps.nx) for _ in range(args.groups)]
+
+    t1 = time.time()
+    index_8nb = build_lut_baseline(tps.ny, tps.nx)
+    print('lookup table build time: ', time.time() - t1)
+
+    # Compile the kernel before timing.
+    coords_flat, _, _, offsets = tps.flatten_spikes(groups[0])
+    tps.accumulate_spikes(coords_flat, offsets)
+
+    dt_base = 0
+    dt_new = 0
+    n_coincidentals = 0
+    for spikes_list in groups:
+        t1 = time.time()
+        base = list(accumulate_spikes_baseline(spikes_list, index_8nb))
+        t2 = time.time()
+        coords_flat, _, _, offsets = tps.flatten_spikes(spikes_list)
+        new = tps.accumulate_spikes(coords_flat, offsets)
+        t3 = time.time()
+        dt_base += t2 - t1
+        dt_new += t3 - t2
+        # The baseline returns the spikes sorted by coordinate, the new implementation in file order.
+        for w, (coords, idx, counts) in enumerate(zip(*new)):
+            order = np.argsort(coords)
+            assert np.array_equal(base[0][w], coords[order]), 'coordinates differ'
+            assert np.array_equal(base[1][w], idx[order]), 'indices differ'
+            assert np.array_equal(base[2][w], counts[order]), 'counts differ'
+            n_coincidentals += coords.size
+
+    print('groups: ', len(groups), ' coincidental spikes: ', n_coincidentals, ' all identical')
+    print('baseline time per group (ms): ', 1e3 * dt_base / len(groups))
+    print('numba time per group (ms): ', 1e3 * dt_new / len(groups))
+
+
+if __name__ == '__main__':
+    main()
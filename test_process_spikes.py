@@ -1,8 +1,11 @@
 import os
+import time
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 from astropy.io import fits
 import fitsio
+from numba import njit, prange, set_num_threads
 
 
 def get_filepaths(group_nb, file_paths, unique_indices, group_count, data_directory):
@@ -20,13 +23,15 @@ def get_filepaths(group_nb, file_paths, unique_indices, group_count, data_direct
     path_index = unique_indices[group_nb]
     # Get how many files in the group (should typically be 7, for 7 wavelengths)
     count = group_count[group_nb]
-    paths = [os.path.join(data_directory, fpath[0].decode('UTF-8')) for fpath in file_paths[path_index:path_index + count]]
+    # Paths are str in the parquet database. os.fsdecode() also accepts bytes paths.
+    paths = [os.path.join(data_directory, os.fsdecode(fpath)) for fpath in file_paths[path_index:path_index + count]]
     return paths
 
 
 def delete_files(folder):
-    for filename in os.listdir(folder):
-        os.remove(os.path.abspath(os.path.join(folder, filename)))
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            os.unlink(entry.path)
 
 
 def filter_spike_file_rename(n_co_spikes, old_filename, output_dir):
@@ -36,56 +41,111 @@ def filter_spike_file_rename(n_co_spikes, old_filename, output_dir):
     return os.path.join(output_dir, basename.replace('spikes', new_name))
 
 
-def count_intersect(raw_spikes, coincidental_1d_coords, count_filter_idx, counts):
-    """ Provides the coincidental coordinates and their indices in the raw spike file and occurence count
-    within the group. The indices in the raw spike file are used to retrieve the intensity values (before/after)
+@njit(parallel=True, cache=True)
+def accumulate_kernel(coords_flat, offsets, nb_coords, ny, nx):
+    """ Count, for each pixel, how many wavelengths have a spike within its 8 nearest neighbours.
+    The neighbours are computed on the fly from the relative coordinates instead of a (9, nx*ny) lookup table.
+    Off-edge neighbours are skipped: clipping them to the edge would only give pixels already in the neighbourhood.
 
-    :param raw_spikes: list of spikes for one wavelength
-    :param coincidental_1d_coords: list of 1D coordinates of coincidental spikes integrated for the whole group
-    :param count_filter_idx: list of indices of the coincidental spikes mapping to the original list of spikes coords.
-    :param counts: distribution of spikes coords
-    :return: Coincidental coordinates, index in spike file, number of occurences >=n_co_spikes
+    :param coords_flat: 1D coordinates of the spikes of all the wavelengths of the group, concatenated.
+    :param offsets: start of each wavelength in coords_flat, with the total number of spikes appended.
+    :param nb_coords: relative 2D coordinates [row, col] of the 8 neighbours (+ origin pixel)
+    :param ny: number of rows of the detector
+    :param nx: number of columns of the detector
+    :return: distribution of the spikes coordinates over all the pixels (uint8).
     """
-
-    file_coords, idx1, idx2 = np.intersect1d(raw_spikes[0, :], coincidental_1d_coords, return_indices=True)
-    # Retrieve how many coincidental hits we had within the 8 neighbours.
-    group_counts = counts[count_filter_idx[idx2]]
-    return file_coords, idx1, group_counts
+    counts = np.zeros(ny * nx, dtype=np.uint8)
+    presence = np.zeros(ny * nx, dtype=np.uint8)
+    for w in range(offsets.size - 1):
+        # Flag the neighbourhood of the spikes of that wavelength. Concurrent writes all store 1, so no race.
+        for i in prange(offsets[w], offsets[w + 1]):
+            y = coords_flat[i] // nx
+            x = coords_flat[i] % nx
+            for j in range(nb_coords.shape[0]):
+                yy = y + nb_coords[j, 0]
+                xx = x + nb_coords[j, 1]
+                if 0 <= yy < ny and 0 <= xx < nx:
+                    presence[yy * nx + xx] = 1
+        # Count each flagged pixel once for that wavelength and reset the flag. Only the pixels that were set are
+        # visited, which avoids sweeping over the whole detector for each wavelength.
+        for i in range(offsets[w], offsets[w + 1]):
+            y = coords_flat[i] // nx
+            x = coords_flat[i] % nx
+            for j in range(nb_coords.shape[0]):
+                yy = y + nb_coords[j, 0]
+                xx = x + nb_coords[j, 1]
+                if 0 <= yy < ny and 0 <= xx < nx and presence[yy * nx + xx]:
+                    counts[yy * nx + xx] += 1
+                    presence[yy * nx + xx] = 0
+    return counts
+
+
+def flatten_spikes(spikes_list):
+    """ Concatenate the spikes of a group into one array per column (structure of arrays), so that all wavelengths
+    are processed at once. Wavelength w is found at [offsets[w]:offsets[w+1]].
+
+    :param spikes_list: list of spikes arrays read from the spikes files
+    :return: 1D coordinates (int32), intensities before and after despiking (int16), offsets of each wavelength
+    """
+    coords_flat = np.concatenate([raw_spikes[0, :] for raw_spikes in spikes_list]).astype(np.int32)
+    before_flat = np.concatenate([raw_spikes[1, :] for raw_spikes in spikes_list]).astype(np.int16)
+    after_flat = np.concatenate([raw_spikes[2, :] for raw_spikes in spikes_list]).astype(np.int16)
+    offsets = np.cumsum([0] + [raw_spikes.shape[1] for raw_spikes in spikes_list])
+    return coords_flat, before_flat, after_flat, offsets
 
 
-def accumulate_spikes(spikes_list, n_co_spikes=2):
+def accumulate_spikes(coords_flat, offsets, n_co_spikes=2):
     """
     Within a group of up to 7 files:
     - accumulate a list of 1D coordinates within the 8 nearest neighbours of a spike coordinate.
     - get the coordinates that is populated more than once
     - create a mask for each spike file that maps ones to those coordinates satisfying the coincidental criterion above.
 
-    REQUIRES NUMPY >= 1.15 for returning indices out of numpy.intersect1d()
+    The coordinates are assumed to be unique within each spikes file. If a coordinate is repeated in a file, every
+    occurence is returned, where the former np.intersect1d implementation only kept the first one.
 
-    :param spikes_list:
-    :return:
+    :param coords_flat: 1D coordinates of the spikes of all the files of the group, concatenated (see flatten_spikes)
+    :param offsets: start of each file in coords_flat, with the total number of spikes appended.
+    :param n_co_spikes: minimum number of wavelengths where a spike must occur within the 8 nearest neighbours.
+    :return: per file: coincidental coordinates, their index in the spike file, their number of occurences.
+    Within each file, the spikes are in the order of the spikes file, not sorted by coordinate. The filtered files
+    are written in that order too.
     """
 
-    # spikes list: [7 files] x [1D coordinates, intensity before despiking replacement, intensity after despiking]
-    cumulated_spikes_coords = np.unique(index_8nb[:, spikes_list[0][0, :]].ravel())
-    for raw_spikes in spikes_list[1:]:
-        # Accumulate the coordinates across the 7 files into a single 1D array.
-        cumulated_spikes_coords = np.concatenate([cumulated_spikes_coords, np.unique(index_8nb[:, raw_spikes[0, :]].ravel())])
-    # Make a curated distribution (numbers that do not exist aren't covered by the algorithm => faster than histogram)
-    (distrib_values, counts) = np.unique(cumulated_spikes_coords, return_counts=True) # 35 ms
-    # Get the indices of the coordinates that get hit more than n_co_spikes times
-    count_filter_idx = np.where(counts >= n_co_spikes)[0]
-    # Get these coincicental spikes coordinates
-    coincidental_1d_coords = distrib_values[count_filter_idx] # 1 ms
+    # The coordinates are bounded by the detector size, so the distribution is accumulated in a dense array instead of
+    # sorting the concatenated coordinates with np.unique. Each wavelength contributes at most once per pixel.
+    counts = accumulate_kernel(coords_flat, offsets, coords_8nb, ny, nx)
     # Here we have "lost" the info of from which wavelength these hits come from, and how many exactly.
-    # Get back to that information by intersecting these coincidental coordinates per wavelength (per file in the group)
-    group_coords, group_idx, group_counts = zip(*[count_intersect(raw_spikes, coincidental_1d_coords, count_filter_idx, counts)
-                                                  for raw_spikes in spikes_list])
+    # Get back to that information by reading the distribution at the spikes of all the files at once. A spike is
+    # coincidental if its own pixel got hit at least n_co_spikes times. The result is then split per wavelength (per file
+    # in the group)
+    spikes_counts = counts[coords_flat]
+    valid = spikes_counts >= n_co_spikes
+    group_coords, group_idx, group_counts = [], [], []
+    for w in range(len(offsets) - 1):
+        idx1 = np.nonzero(valid[offsets[w]:offsets[w + 1]])[0]
+        group_coords.append(coords_flat[offsets[w] + idx1])
+        group_idx.append(idx1)
+        # Retrieve how many coincidental hits we had within the 8 neighbours.
+        group_counts.append(spikes_counts[offsets[w] + idx1])
 
-    # coincidental_spikes_masks = [np.isin(raw_spikes[0, :], coincidental_1d_coords) for raw_spikes in spikes_list]
     return group_coords, group_idx, group_counts
 
 
+def filter_spikes(spikes_list, fpaths, n_co_spikes=2, hdu_only=False):
+    """ Filter the coincidental spikes of a group and write them in new files.
+
+    :param spikes_list: spikes read from the files of the group
+    :param fpaths: paths of the spikes files of the group
+    :param n_co_spikes: minimum number of wavelengths where a spike must occur within the 8 nearest neighbours.
+    :param hdu_only: see process_spikes()
+    """
+    coords_flat, before_flat, after_flat, offsets = flatten_spikes(spikes_list)
+    group_coords,  group_idx, group_counts = accumulate_spikes(coords_flat, offsets, n_co_spikes=n_co_spikes)
+    write_new_spikes_files2(before_flat, after_flat, offsets, group_coords, group_idx, group_counts, fpaths,
+                            n_co_spikes=n_co_spikes, hdu_only=hdu_only)
+
+
 def process_spikes(group_index, n_co_spikes=2, hdu_only=False):
     """
      Get the paths to all files belonging to the group numbered by group_index.
@@ -100,12 +160,32 @@ def process_spikes(group_index, n_co_spikes=2, hdu_only=False):
     # Read spikes fits files. They contain 3 columns:
     # (1) 1D coordinates, (2) intensity before despiking replacement, (3) intensity after despiking.
     spikes_list = [fitsio.read(path) for path in fpaths]
-    group_coords,  group_idx, group_counts = accumulate_spikes(spikes_list)
-    write_new_spikes_files2(spikes_list, group_coords, group_idx, group_counts, fpaths, hdu_only=hdu_only)
+    filter_spikes(spikes_list, fpaths, n_co_spikes=n_co_spikes, hdu_only=hdu_only)
 
     return group_index
 
 
+def init_worker():
+    """ Pool initializer. The groups are already spread over one process per cpu, so each worker runs the prange
+    loops of accumulate_kernel on a single thread instead of starting one Numba thread per cpu as well.
+    """
+    set_num_threads(1)
+
+
+def process_all_groups(group_indices, n_workers=None, chunksize=16):
+    """ Process the given groups in parallel. Each group is independent of the others.
+
+    :param group_indices: group numbers as given by grouping the database by unique group indices.
+    :param n_workers: number of worker processes. Defaults to the number of cpus.
+    :param chunksize: number of groups sent at once to a worker, to amortize inter-process communication.
+    """
+    # fitsio holds the GIL while reading, so the reads are not threaded within a worker. They overlap with the
+    # computation of the other workers instead.
+    with Pool(n_workers, initializer=init_worker) as pool:
+        for _ in pool.imap_unordered(process_spikes, group_indices, chunksize=chunksize):
+            pass
+
+
 def write_new_spikes_files(spikes_list, group_coords, group_idx, group_counts, paths, n_co_spikes=2, hdu_only=False):
     for i, (raw_spikes, coords, spike_idx, counts) in enumerate(zip(spikes_list, group_coords, group_idx, group_counts)):
         data_stack = np.stack((coords, raw_spikes[1, spike_idx], raw_spikes[2, spike_idx], counts))
@@ -119,19 +199,25 @@ def write_new_spikes_files(spikes_list, group_coords, group_idx, group_counts, p
     return
 
 
-def write_new_spikes_files2(spikes_list, group_coords, group_idx, group_counts, paths, n_co_spikes=2, hdu_only=False):
-    for i, (raw_spikes, coords, spike_idx, counts) in enumerate(zip(spikes_list, group_coords, group_idx, group_counts)):
-
-        col1 = fits.Column(name='coords', format='J', array=coords.astype(np.int32))
-        col2 = fits.Column(name='before', format='K', array=raw_spikes[1, spike_idx].astype(np.int16))
-        col3 = fits.Column(name='after', format='K', array=raw_spikes[2, spike_idx].astype(np.int16))
-        col4 = fits.Column(name='counts', format='B', array=counts.astype(np.byte))
-        coldefs = fits.ColDefs([col1, col2, col3, col4])
-        hdu = fits.BinTableHDU.from_columns(coldefs)
+def write_new_spikes_files2(before_flat, after_flat, offsets, group_coords, group_idx, group_counts, paths,
+                            n_co_spikes=2, hdu_only=False):
+    # Binary table written in one go by fitsio. The table is allocated once for the whole group at the size of the
+    # largest file, and each file writes a view of its first rows.
+    table_dtype = [('coords', '<i4'), ('before', '<i2'), ('after', '<i2'), ('counts', 'u1')]
+    table = np.empty(max(coords.size for coords in group_coords), dtype=table_dtype)
+    for i, (coords, spike_idx, counts) in enumerate(zip(group_coords, group_idx, group_counts)):
+        # Indices of the spikes of that file in the flat arrays of the group.
+        flat_idx = offsets[i] + spike_idx
+        rec = table[:coords.size]
+        rec['coords'] = coords
+        rec['before'] = before_flat[flat_idx]
+        rec['after'] = after_flat[flat_idx]
+        rec['counts'] = counts
+        if hdu_only:
+            continue
         # Write the new fits files
         new_name = filter_spike_file_rename(n_co_spikes, paths[i], output_dir)
-        hdu.writeto(new_name, overwrite=True)
-        #hdu.writeto(new_name)
+        fitsio.write(new_name, rec, clobber=True)
     return
 
 
@@ -158,7 +244,8 @@ db_filepath = os.path.join(data_dir, 'spikes_df_2010.parquet')
 output_dir = os.path.join(data_dir, 'filtered')
 # Open the data base as a store.
 # spikes_db = pd.HDFStore(db_filepath)
-spikes_db = pd.read_parquet(db_filepath, engine='pyarrow')
+# Only the group numbers and the paths are used. Parquet is columnar, so the other columns are not even read.
+spikes_db = pd.read_parquet(db_filepath, engine='pyarrow', columns=['GroupNumber', 'Path'])
 ####################################################################################################
 # Break out file paths grouped by group numbers out of the database (why did I do the above then?).
 # There should be a Pandas' way to extract file paths by same group numbers.
@@ -169,34 +256,15 @@ nppaths = spikes_db.get('Path').values
 # Filter the unique values of groups (ugroups), and output associated indices (uinds) and counts for each group (ugroupc)
 ugroups, uinds, ugroupc = np.unique(npgroups, return_index=True, return_counts=True)
 
-################################################################################################
-# Pre-compute the 8-connectivity lookup table. This will be shared across parallel workers.
-################################################################################################
+# Size of the 4096 x 4096 detector. Matrix convention is kept. [rows, cols] = [y-axis, x-axis]
+ny, nx = [4096, 4096]
 # List of relative 2D coordinates for 8-neighbour connectiviy (9-element list). 1st one is the origin pixel.
 coords_8nb = np.array([[0, 0], [-1, 0], [-1, -1], [0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1]])
-# Array of 2D coordinates for a 4096 x 4096 array. Matrix convention is kept. [rows, cols] = [y-axis, x-axis]
-ny, nx = [4096, 4096]
-coords_1d = np.arange(nx * ny)
-coordy, coordx = np.unravel_index(coords_1d, [ny, nx]) # also possible by raveling a meshgrid() output
-coords2d = np.array([coordy, coordx])
-# Create the array of 2D coordinates of 8-neighbours associated with each pixel.
-# pixel 0 has 8 neighbour + itself, pixel 1 has 8 neighbour + itself, etc...
-coords2d_8nb = coords2d[np.newaxis, ...] + coords_8nb[..., np.newaxis]
-# Handle off-edges coordinates by clipping to the edges, operation done in-place. Here, square detector assumed. Update
-# to per-axis clipping if that ever changes for another instrument.
-np.clip(coords2d_8nb, 0, nx-1, out=coords2d_8nb)
-# Convert to 1D coordinates.
-index_8nb = np.array([coords2d_8nb[i, 0, :] * nx + coords2d_8nb[i, 1, :] for i in range(len(coords_8nb))],
-                     dtype='int32', order='C')
-
-# for group_n in ugroups:
-group_n = 0
-
-fpaths = get_filepaths(group_n, nppaths, uinds, ugroupc, data_dir)
-# Read spikes fits files. They contain 3 columns:
-# (1) 1D coordinates, (2) intensity before despiking replacement, (3) intensity after despiking.
-spikes_list = [fitsio.read(path) for path in fpaths]
-group_coords, group_idx, group_counts = accumulate_spikes(spikes_list)
-write_new_spikes_files2(spikes_list, group_coords, group_idx, group_counts, fpaths, hdu_only=False)
 
 
+if __name__ == '__main__':
+    t1 = time.time()
+    process_all_groups(range(len(ugroups)))
+    t2 = time.time()
+    dt1 = t2 - t1
+    print('wall clock time elapsed: ', dt1)